@@ -7,16 +7,24 @@ Date: Nov 2018
 
 import sys
 import os
-import json
 import re
-import codecs
+import shutil
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from . import Devices
-from lxml import etree
 from datetime import datetime
-from itertools import cycle
 
 
 _debug = False
+_fileBuffering = 1 << 16  # Bytes of buffer for the log and output files
+_logBatchSize = 64  # Log lines kept in memory before writing to the log file
+_maxWorkers = 32  # Default devices contacted at once by Activity.run()
+_spoolSize = 8 * 1024 * 1024  # Bytes of a device output kept in memory
+_fileNameCleaner = re.compile(r'[^-a-zA-Z0-9_.]+')
+_outputFooter = b"\n--------------------------------------------------\n"
 
 
 class Activity(object):
@@ -60,22 +68,37 @@ class Activity(object):
             indicates which type of Device to use.
     """
 
-    name = ""
-    description = ""
-    user = ""
-    password = ""
-    superuserPassword = ""
-    superuserNeeded = False
-    targets = []
-    commands = []
-    outputDir = None
-    logDir = None
-    logFilename = ""
-    outputFilename = ""
-    logFile = sys.stderr
-    outputFile = sys.stdout
-    singleFile = False
-    deviceType = ""
+    __slots__ = (
+        'name', 'description', 'user', 'password', 'superuserPassword',
+        'superuserNeeded', 'targets', 'commands', 'outputDir', 'logDir',
+        'logFilename', 'outputFilename', 'logFile', 'outputFile',
+        'singleFile', 'deviceType',
+        '_logBuffer', '_logSecond', '_logTimestamp', '_logLock',
+        '_outputLock')
+
+    def __init__(self):
+        """Build."""
+        self.name = ""
+        self.description = ""
+        self.user = ""
+        self.password = ""
+        self.superuserPassword = ""
+        self.superuserNeeded = False
+        self.targets = []
+        self.commands = []
+        self.outputDir = None
+        self.logDir = None
+        self.logFilename = ""
+        self.outputFilename = ""
+        self.logFile = sys.stderr
+        self.outputFile = sys.stdout
+        self.singleFile = False
+        self.deviceType = ""
+        self._logBuffer = []
+        self._logSecond = None
+        self._logTimestamp = ""
+        self._logLock = threading.Lock()
+        self._outputLock = threading.Lock()
 
     def loadFromXML(self, filename):
         """Load the Activity values from the XML File.
@@ -89,37 +112,61 @@ class Activity(object):
         * filename: Path to the XML file to read
 
         """
+        from lxml import etree
         try:
-            tree = etree.parse(filename)
-            root = tree.getroot()
-            self.name = root.attrib['name']
-            self.user = root.find('login').get('user')
-            self.password = root.find('login').get('password')
+            self.targets = []
+            self.commands = []
+            context = etree.iterparse(
+                filename,
+                events=('end',),
+                tag=('activity', 'desc', 'login', 'superuserPassword',
+                     'output', 'log', 'devices', 'commands'))
+            login = None
+            superuserPassword = None
+            for _, elem in context:
+                parent = elem.getparent()
+                if parent is None:
+                    # The <activity> root is the last element to end
+                    self.name = elem.attrib['name']
+                    continue
+                if parent.getparent() is not None:
+                    # Only the direct children of <activity> are considered
+                    continue
+                tag = elem.tag
+                if tag == 'login':
+                    login = (elem.get('user'), elem.get('password'))
+                elif tag == 'desc':
+                    self.description = elem.text
+                elif tag == 'superuserPassword':
+                    superuserPassword = elem.get('password')
+                elif tag == 'output':
+                    self.outputDir = elem.get('dir')
+                    if (elem.get('singleFile') or '').lower() == 'yes':
+                        self.singleFile = True
+                elif tag == 'log':
+                    self.logDir = elem.get('dir')
+                elif tag == 'devices':
+                    deviceType = elem.get('type')
+                    if deviceType is not None:
+                        self.deviceType = deviceType
+                    self.targets = [host.text for host in elem]
+                elif tag == 'commands':
+                    self.commands = [cmd.text for cmd in elem]
+                # Free the subtree already read, and its processed siblings
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+            if login is None:
+                raise KeyError('login')
+            self.user, self.password = login
             self.password = xor_decrypt_string(self.password, self.user)
-            if root.find('desc') is not None:
-                self.description = root.find('desc').text
-            if root.find('superuserPassword') is not None:
+            if superuserPassword is not None:
                 self.superuserNeeded = True
-                self.superuserPassword = root.find(
-                    'superuserPassword').get('password')
                 self.superuserPassword = xor_decrypt_string(
-                    self.superuserPassword, self.user)
-            if root.find('output') is not None:
-                self.outputDir = root.find('output').get('dir')
-                if root.find('output').get('singleFile').lower() == 'yes':
-                    self.singleFile = True
-            if root.find('log') is not None:
-                self.logDir = root.find('log').get('dir')
-            self.targets = []
-            self.commands = []
-            if root.find('devices').get('type') is not None:
-                self.deviceType = root.find('devices').get('type')
-            for host in root.find('devices'):
-                self.targets.append(host.text)
-            for cmd in root.find('commands'):
-                self.commands.append(cmd.text)
+                    superuserPassword, self.user)
             return True
-        except (etree.ParseError, KeyError) as e:
+        except (etree.ParseError, KeyError, ValueError) as e:
+            # ValueError: a password that cannot be decrypted
             sys.stderr.write(
                 "Activity-Load: Elements missing from the XML file\n")
             if _debug:
@@ -136,64 +183,46 @@ class Activity(object):
         * filename: Path to the XML file to read
 
         """
-        try:
-            ActivityRoot = etree.Element('activity', {'name': self.name})
-            if self.description:
-                d = etree.SubElement(ActivityRoot, 'desc')
-                d.text = self.description
+        from lxml import etree
+        loginAttrib = {
+            'user': self.user,
+            'password': xor_crypt_string(self.password, self.user)
+        }
+        devicesAttrib = {'type': self.deviceType} if self.deviceType else {}
+        ActivityRoot = etree.Element('activity', {'name': self.name})
+        if self.description:
+            etree.SubElement(ActivityRoot, 'desc').text = self.description
+        etree.SubElement(ActivityRoot, 'login', loginAttrib)
+        if self.superuserNeeded:
             etree.SubElement(
                 ActivityRoot,
-                'login',
+                'superuserPassword',
                 {
-                    'user': self.user,
-                    'password': xor_crypt_string(self.password, self.user)
+                    'password': xor_crypt_string(
+                        self.superuserPassword,
+                        self.user)
                 })
-            if self.superuserNeeded:
-                etree.SubElement(
-                    ActivityRoot,
-                    'superuserPassword',
-                    {
-                        'password': xor_crypt_string(
-                            self.superuserPassword,
-                            self.user)
-                    })
-            if self.deviceType:
-                dev = etree.SubElement(
-                    ActivityRoot,
-                    'devices',
-                    {'type': self.deviceType})
-            else:
-                dev = etree.SubElement(ActivityRoot, 'devices')
-            for t in self.targets:
-                h = etree.SubElement(dev, 'hostname')
-                h.text = t
-            cmd = etree.SubElement(ActivityRoot, 'commands')
-            for c in self.commands:
-                line = etree.SubElement(cmd, 'cmd')
-                line.text = c
-            if self.outputDir:
-                etree.SubElement(
-                    ActivityRoot,
-                    'output',
-                    {
-                        'dir': self.outputDir,
-                        'singleFile': ('Yes' if self.singleFile else 'No')
-                    })
-            if self.logDir:
-                etree.SubElement(ActivityRoot, 'log', {'dir': self.logDir})
-            tree = etree.ElementTree()
-            tree._setroot(ActivityRoot)
-        except etree.ParseError as e:
-            sys.stderr.write(
-                "Activity-Write: Some elements are missing to the XML file\n")
-            if _debug:
-                sys.stderr.write("Activity-Write Exception %s" % e)
-            return False
+        dev = etree.SubElement(ActivityRoot, 'devices', devicesAttrib)
+        for t in self.targets:
+            etree.SubElement(dev, 'hostname').text = t
+        cmd = etree.SubElement(ActivityRoot, 'commands')
+        for c in self.commands:
+            etree.SubElement(cmd, 'cmd').text = c
+        if self.outputDir:
+            etree.SubElement(
+                ActivityRoot,
+                'output',
+                {
+                    'dir': self.outputDir,
+                    'singleFile': ('Yes' if self.singleFile else 'No')
+                })
+        if self.logDir:
+            etree.SubElement(ActivityRoot, 'log', {'dir': self.logDir})
+        tree = etree.ElementTree(ActivityRoot)
         try:
             totalPath = os.path.abspath(filename)
             directory = os.path.dirname(totalPath)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
             tree.write(totalPath, pretty_print=True)
             return True
         except (IOError, OSError) as e:
@@ -205,6 +234,7 @@ class Activity(object):
 
     def writeToJSON(self, filename):
         """See writeToXML."""
+        import json
         data = dict()
         data['name'] = self.name
         data['desc'] = self.description
@@ -227,55 +257,49 @@ class Activity(object):
         try:
             totalPath = os.path.abspath(filename)
             directory = os.path.dirname(totalPath)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
-            with open(filename, 'w') as outfile:
-                json.dump(
-                    data,
-                    outfile,
-                    ensure_ascii=True,
-                    indent=4,
-                    separators=(',', ': '))
+            os.makedirs(directory, exist_ok=True)
+            text = json.dumps(
+                data,
+                ensure_ascii=True,
+                indent=4,
+                separators=(',', ': '))
+            with open(filename, 'w', buffering=_fileBuffering) as outfile:
+                outfile.write(text)
             return True
         except (IOError, ValueError, OSError) as e:
             sys.stderr.write(
-                "Activity-Write: Errors trying to write to '%s'\n" % (
+                "Activity-Write: Errors trying to write to '%s': %s\n" % (
                     totalPath, e
                 ))
             return False
 
     def loadFromJSON(self, filename):
         """See also loadFromXML."""
+        import json
         try:
             with open(filename) as data_file:
                 data = json.load(data_file)
+            self.name = data['name']
+            self.user = data['login']
+            self.password = xor_decrypt_string(data['password'], self.user)
+            self.targets = data['devices']
+            self.commands = data['commands']
+            if 'superuserPassword' in data:
+                self.superuserPassword = xor_decrypt_string(
+                    data['superuserPassword'],
+                    self.user)
+                self.superuserNeeded = True
         except (KeyError, ValueError, OSError) as e:
             sys.stderr.write(
                 "Activity-Load: Elements are missing from the JSON file\n")
             if _debug:
                 sys.stderr.write("Activity-Load Exception %s" % e)
             return False
-        self.name = data['name']
-        self.user = data['login']
-        self.password = data['password']
-        self.password = xor_decrypt_string(self.password, self.user)
-        self.targets = data['devices']
-        self.commands = data['commands']
-        try:
-            self.deviceType = data['type']
-            self.outputDir = data['outputDir']
-            self.singleFile = data['singleFile']
-            self.logDir = data['logDir']
-        except KeyError:
-            pass
-        try:
-            self.superuserPassword = data['superuserPassword']
-            self.superuserPassword = xor_decrypt_string(
-                self.superuserPassword,
-                self.user)
-            self.superuserNeeded = True
-        except KeyError:
-            pass
+        self.description = data.get('desc', self.description)
+        self.deviceType = data.get('type', self.deviceType)
+        self.outputDir = data.get('outputDir', self.outputDir)
+        self.singleFile = data.get('singleFile', self.singleFile)
+        self.logDir = data.get('logDir', self.logDir)
         return True
 
     def check(self):
@@ -312,21 +336,23 @@ class Activity(object):
     def printSummary(self):
         """Print some basic info about the Activity to STDOUT."""
         print("-------------Activity-------------------")
-        print("\tName: %s " % self.name)
-        print("\tUser: %s " % self.user)
+        print(f"\tName: {self.name} ")
+        print(f"\tUser: {self.user} ")
         if self.superuserNeeded:
             print("\tSuperuser: YES ")
         if self.deviceType:
-            print("\tDevice type: %s " % self.deviceType)
-        print("\tDevices: %d " % len(self.targets))
+            print(f"\tDevice type: {self.deviceType} ")
+        print(f"\tDevices: {len(self.targets)} ")
         if self.singleFile:
-            print("\tOutput File: %s " % os.path.join(
-                self.outputDir, timestampedFilename(self.name+"_OUT")))
+            outputPath = os.path.join(
+                self.outputDir, timestampedFilename(f"{self.name}_OUT"))
+            print(f"\tOutput File: {outputPath} ")
         elif self.outputDir:
-            print("\tOutput Folder: %s  " % self.outputDir)
+            print(f"\tOutput Folder: {self.outputDir}  ")
         if self.logDir:
-            print("\tLog File: %s  " % os.path.join(
-                self.logDir, timestampedFilename(self.name+"_LOG")))
+            logPath = os.path.join(
+                self.logDir, timestampedFilename(f"{self.name}_LOG"))
+            print(f"\tLog File: {logPath}  ")
         print("----------------------------------------")
 
     def printCredentials(self):
@@ -338,60 +364,131 @@ class Activity(object):
             print("\tPowerPassword: " + self.superuserPassword)
         print("--------------------------------------------")
 
-    def run(self):
+    def run(self, workers=_maxWorkers):
         """Run the activity.
 
+        The targets are contacted in parallel, up to 'workers' at a time.
+
         Errors are placed in the LogFile of the Activity.
+
+        Parameters:
+        * workers: Maximum number of devices to connect to at the same time.
+            With 1, the devices are processed one after the other.
+
         """
-        self.outputFilename = timestampedFilename(self.name+"_OUT")
-        self.logFilename = timestampedFilename(self.name+"_LOG")
+        self.outputFilename = timestampedFilename(f"{self.name}_OUT")
+        self.logFilename = timestampedFilename(f"{self.name}_LOG")
         self._openLogFile()
-        if self.singleFile:
-            self._openOutputFile(self.outputFilename)
-        for hostname in self.targets:
-            aDevice = Devices.createDevice(hostname, self.deviceType)
+        try:
+            if self.singleFile:
+                self.outputFile = self._openOutputFile(self.outputFilename)
+            try:
+                self._runAll(workers)
+                self._writeLogFile("Finished activity")
+            finally:
+                if self.singleFile:
+                    self._closeOutputFile(self.outputFile)
+            self._writeLogFile("END")
+        finally:
+            # Also on errors or Ctrl-C, the queued log lines are written
+            self._closeLogFile()
+
+    def _runAll(self, workers):
+        """Run _runOne() for all the targets, up to 'workers' at a time."""
+        deviceClass = Devices.deviceFactoryFor(self.deviceType)
+        workers = max(1, min(workers, len(self.targets)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._runOne, hostname, deviceClass)
+                for hostname in self.targets]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _runOne(self, hostname, deviceClass):
+        """Run the commands on a single target.
+
+        Called from the worker threads of run(), with the Device class
+            already resolved from the Activity.deviceType.
+        """
+        aDevice = deviceClass(hostname)
+        try:
             if not aDevice.connect(self.user, self.password):
                 self._writeLogFile(
-                    "Unable to connect to " + hostname
-                    + ". Test with a local SSH session.")
-                continue
-            self._writeLogFile("Connected to " + hostname)
+                    f"Unable to connect to {hostname}."
+                    " Test with a local SSH session.")
+                return
+            self._writeLogFile(f"Connected to {hostname}")
             if not aDevice.login():
                 self._writeLogFile(
-                    "Unable to login to " + hostname
-                    + ". \t Test with the default Device type.")
-                continue
+                    f"Unable to login to {hostname}."
+                    " \t Test with the default Device type.")
+                return
             if self.superuserNeeded:
                 if not aDevice.superuser(self.superuserPassword):
-                    self._writeLogFile("Unable to superuser at "+hostname)
-                    continue
+                    self._writeLogFile(f"Unable to superuser at {hostname}")
+                    return
                 else:
-                    self._writeLogFile("Superuser at "+hostname)
-            if not self.singleFile:
-                self._openOutputFile(timestampedFilename(hostname))
-            self._writeOutputFile(
-                "\n----------------%s--------------\n" % hostname)
-            if not aDevice.run(self.commands, self.outputFile):
+                    self._writeLogFile(f"Superuser at {hostname}")
+            if self.singleFile:
+                outputFile = self.outputFile
+            else:
+                outputFile = self._openOutputFile(
+                    timestampedFilename(hostname))
+            # The single file and STDOUT are shared by all the workers, so
+            #   the output of the device is collected and copied at once
+            shared = self.singleFile or not self.outputDir
+            if shared:
+                hostOutput = tempfile.SpooledTemporaryFile(_spoolSize)
+            else:
+                hostOutput = outputFile
+            hostOutput.write(
+                f"\n----------------{hostname}--------------\n".encode())
+            if not aDevice.run(self.commands, hostOutput):
                 self._writeLogFile("ERROR while running the commmands")
             if not aDevice.logout():
                 self._writeLogFile("ERROR while logging out")
-            self._writeOutputFile(
-                "\n--------------------------------------------------\n")
+            hostOutput.write(_outputFooter)
+            if shared:
+                self._writeOutputFile(outputFile, hostOutput)
+                hostOutput.close()
             if not self.singleFile:
-                self._closeOutputFile()
-            self._writeLogFile("Finished commands at " + hostname)
-        self._writeLogFile("Finished activity")
-        if self.singleFile:
-            self._closeOutputFile()
-        self._writeLogFile("END")
-        self._closeLogFile()
+                self._closeOutputFile(outputFile)
+            self._writeLogFile(f"Finished commands at {hostname}")
+        finally:
+            aDevice.close()
 
     def _writeLogFile(self, msg):
-        self.logFile.write(
-            datetime.now().strftime('%H:%M:%S')+": " + msg + "\n")
+        """Queue a timestamped message for the LogFile.
 
-    def _writeOutputFile(self, msg):
-        self.outputFile.write(msg)
+        Messages are written in batches of _logBatchSize lines,
+            or one by one if the LogFile is STDERR.
+        """
+        with self._logLock:
+            second = int(time.time())
+            if second != self._logSecond:
+                self._logSecond = second
+                self._logTimestamp = time.strftime(
+                    '%H:%M:%S', time.localtime(second))
+            self._logBuffer.append(f"{self._logTimestamp}: {msg}\n")
+            if not self.logDir or len(self._logBuffer) >= _logBatchSize:
+                self._flushLogFile()
+
+    def _flushLogFile(self):
+        self.logFile.writelines(self._logBuffer)
+        self._logBuffer = []
+
+    def _writeOutputFile(self, outputFile, hostOutput):
+        """Copy all the hostOutput into the shared outputFile."""
+        hostOutput.seek(0)
+        with self._outputLock:
+            shutil.copyfileobj(hostOutput, outputFile, _fileBuffering)
+            if not self.outputDir:
+                outputFile.flush()
 
     def _openLogFile(self):
         """Ope the corresponding LogFile and keep it open.
@@ -400,11 +497,14 @@ class Activity(object):
 
         Raises IOError if there is a Log directory but no writing is possible.
         """
+        self._logBuffer = []
+        self._logSecond = None
         if self.logDir:
             try:
                 self.logFile = open(
                     os.path.join(self.logDir, self.logFilename),
-                    'w')
+                    'w',
+                    buffering=_fileBuffering)
             except OSError:
                 sys.stderr.write(
                     "Activity: Unable to create log file '%s \n"
@@ -414,36 +514,50 @@ class Activity(object):
             self.logFile = sys.stderr
 
     def _openOutputFile(self, filename):
-        """Open the corresponding OutputFile and leave it open.
+        """Open the corresponding OutputFile and return it, left open.
+
+        Either a file in the output or STDOUT, both in binary mode,
+            as the device output is written as received.
 
-        Either a file in the output or STDOUT.
+        An existing file is never overwritten: a target listed twice, run
+            at the same second, gets <filename>_2.txt and so on.
 
         Raises IOError if there is a directory but no writing is possible.
         """
         if self.outputDir:
+            baseName, extension = os.path.splitext(filename)
+            path = os.path.join(self.outputDir, filename)
+            copy = 1
             try:
-                self.outputFile = open(
-                    os.path.join(self.outputDir, filename),
-                    'w')
+                while True:
+                    try:
+                        return open(path, 'xb', buffering=_fileBuffering)
+                    except FileExistsError:
+                        copy += 1
+                        path = os.path.join(
+                            self.outputDir,
+                            f"{baseName}_{copy}{extension}")
             except OSError:
                 sys.stderr.write(
                     "Activity: Unable to create output file '%s'\n"
                     % filename)
                 raise IOError
         else:
-            self.outputFile = sys.stdout
+            sys.stdout.flush()
+            return sys.stdout.buffer
 
     def _closeLogFile(self):
+        self._flushLogFile()
         if self.logDir:
             try:
                 self.logFile.close()
             except OSError:
                 sys.stderr.write("Activity: Unable to close log file  \n")
 
-    def _closeOutputFile(self):
+    def _closeOutputFile(self, outputFile):
         if self.outputDir:
             try:
-                self.outputFile.close()
+                outputFile.close()
             except OSError:
                 sys.stderr.write("Activity: Unable to close output file  \n")
 
@@ -453,9 +567,8 @@ def timestampedFilename(baseFileName):
 
     The 'baseFileName' is cleansed to have only [-a-zA-Z0-9_] characters.
     """
-    return "%s_%s.txt" % (
-        re.sub(r'[^-a-zA-Z0-9_\.]+', '', baseFileName),
-        datetime.now().strftime('%Y%m%d_%H%M%S'))
+    cleanName = _fileNameCleaner.sub('', baseFileName)
+    return f"{cleanName}_{datetime.now():%Y%m%d_%H%M%S}.txt"
 
 
 def testMakeDir(directory):
@@ -471,18 +584,49 @@ def testMakeDir(directory):
     return True
 
 
+@lru_cache(maxsize=64)
 def xor_crypt_string(plaintext, key):
     """Return the chypher of plaintext using the key.
 
+    The XOR is done over the UTF-8 bytes of both strings, see _xor_bytes.
+    Results are cached, as the same credentials are encrypted on every write.
+
     http://stackoverflow.com/questions/11132714/python-two-way-alphanumeric-encryption
     """
-    ciphertext = ''.join(
-        chr(ord(x) ^ ord(y)) for(x, y) in zip(plaintext, cycle(key)))
-    return codecs.encode(ciphertext.encode("utf-8"), "hex").decode("utf-8")
+    ciphertext = _xor_bytes(plaintext.encode("utf-8"), key.encode("utf-8"))
+    return ciphertext.hex()
 
 
+@lru_cache(maxsize=64)
 def xor_decrypt_string(ciphertext, key):
-    """See xor_crypt_string."""
-    ciphertext = codecs.decode(ciphertext, 'hex')
-    return ''.join(
-        chr(x ^ ord(y)) for(x, y) in zip(ciphertext, cycle(key)))
+    """See xor_crypt_string.
+
+    Raises ValueError if the ciphertext is not hex, or not from UTF-8 text.
+
+    >>> xor_decrypt_string(xor_crypt_string("pässword", "cisco"), "cisco")
+    'pässword'
+    """
+    plaintext = _xor_bytes(bytes.fromhex(ciphertext), key.encode("utf-8"))
+    return plaintext.decode("utf-8")
+
+
+def _xor_bytes(data, key):
+    r"""Return data XORed with the key, repeated to the length of data.
+
+    Both byte strings are XORed at once as big integers.
+    An empty key gives an empty result.
+
+    >>> _xor_bytes(b"secret", b"key")
+    b'\x18\x00\x1a\x19\x00\r'
+    >>> _xor_bytes(_xor_bytes(b"secret", b"key"), b"key")
+    b'secret'
+    >>> _xor_bytes(b"secret", b"")
+    b''
+    """
+    if not key:
+        return b""
+    size = len(data)
+    # Just enough repetitions of the key to cover data, rounding up
+    keystream = (key * -(-size // len(key)))[:size]
+    result = int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")
+    return result.to_bytes(size, "big")
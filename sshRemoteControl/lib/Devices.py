@@ -6,16 +6,41 @@ Date: Nov 2018
 """
 
 import paramiko
-import time
+import atexit
+import collections
+import re
+import socket
 import sys
+import threading
+from functools import lru_cache
 import paramiko.ssh_exception as ParamikoExcept
 from socket import error as SocketError
+from socket import timeout as SocketTimeout
 
 # Development log
 # paramiko.common.logging.basicConfig(level=paramiko.common.INFO)
 _debug = False
-_bufferSize = 1024  # Buffer for SSH connection
-listOfDeviceTypes = ("ciscoios", "ciscowlc", "linux")
+_bufferSize = 65536  # Buffer for SSH connection
+_windowSize = 4 * 1024 * 1024  # SSH channel window, data sent before an ACK
+_promptTimeout = 10  # Seconds to wait for the device to answer with a prompt
+_promptScanSize = 64  # Bytes of older data scanned again for a prompt
+_maxIdleConnections = 16  # Unused SSH connections kept open for reuse
+_connectTimeout = 10  # Seconds for each step of the SSH connection
+_keepaliveInterval = 30  # Seconds between keepalives on idle connections
+listOfDeviceTypes = ("ciscoios", "ciscowlc", "linux", "linuxexec")
+# Authenticated SSH connections no longer used by any Device, kept open to
+#   be reused for the same (hostname, username, password). A Device has its
+#   connection for itself while it runs.
+# _idleClients is {paramiko.SSHClient: (hostname, username, password)},
+#   the oldest released first.
+_idleClients = collections.OrderedDict()
+_clientCacheLock = threading.Lock()
+# Host keys are not checked, the same policy object serves all connections
+_hostKeyPolicy = paramiko.AutoAddPolicy()
+# Before the first word of a prompt: escape sequences (bracketed paste mode,
+#   window title) and symbols, see _promptLineRegex()
+_promptLead = rb"(?:\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\r\n]*\x07|[^\w\r\n])*"
+_promptWord = re.compile(_promptLead + rb"([\w.@-]+)")
 
 
 def createDevice(hostname, typeClass=""):
@@ -27,14 +52,173 @@ def createDevice(hostname, typeClass=""):
         the default Device is created. This is a case-insensitive string.
 
     """
-    if typeClass.lower() == "ciscoios":
-        return DeviceCiscoIOS(hostname)
-    elif typeClass.lower() == "ciscowlc":
-        return DeviceCiscoWLC(hostname)
-    elif typeClass.lower() == "linux":
-        return DeviceLinux(hostname)
-    else:
-        return Device(hostname)
+    return deviceFactoryFor(typeClass)(hostname)
+
+
+def deviceFactoryFor(typeClass=""):
+    """Return the Device class that createDevice() uses for the typeClass.
+
+    Resolve it once to create Devices for many hostnames.
+    """
+    return _deviceClasses.get(typeClass.lower(), Device)
+
+
+def _takeIdleClient(hostname, username, password):
+    """Return an unused SSH connection with the same credentials, or None.
+
+    The connection is no longer kept for reuse, the caller has it alone.
+        Give it back with _releaseClient() when done.
+    """
+    key = (hostname, username, password)
+    found = None
+    closing = []
+    with _clientCacheLock:
+        # The most recently used are the most likely to be still active
+        for client in reversed(
+                [c for c, k in _idleClients.items() if k == key]):
+            del _idleClients[client]
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                found = client
+                break
+            closing.append(client)
+    for aClient in closing:
+        aClient.close()
+    return found
+
+
+def _newClient(hostname, username, password):
+    """Return a new paramiko.SSHClient connected to the hostname.
+
+    Give it back with _releaseClient() when done.
+    Raises the paramiko or socket exceptions if the connection fails.
+    """
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(_hostKeyPolicy)
+    try:
+        client.connect(
+            hostname,
+            username=username,
+            password=password,
+            allow_agent=False,
+            look_for_keys=False,
+            compress=False,
+            timeout=_connectTimeout,
+            banner_timeout=_connectTimeout,
+            auth_timeout=_connectTimeout)
+        transport = client.get_transport()
+        transport.set_keepalive(_keepaliveInterval)
+        # Commands are short writes, send them without waiting for ACKs
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except BaseException:
+        # paramiko leaves the transport running after a failed login
+        client.close()
+        raise
+    return client
+
+
+def _releaseClient(hostname, username, password, client):
+    """Keep the client, no longer used by a Device, open for reuse.
+
+    Only the _maxIdleConnections most recently released are kept open.
+    """
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        client.close()
+        return
+    closing = []
+    with _clientCacheLock:
+        _idleClients[client] = (hostname, username, password)
+        while len(_idleClients) > _maxIdleConnections:
+            oldClient, _ = _idleClients.popitem(last=False)
+            closing.append(oldClient)
+    for aClient in closing:
+        aClient.close()
+
+
+def _endsWith(prompt_re, data):
+    """Return True if the prompt_re, anchored at the end, matches the data.
+
+    Only the last line of the data is searched.
+    """
+    return _matchEnd(prompt_re, data) is not None
+
+
+def _matchEnd(prompt_re, data):
+    r"""Return the match of the prompt_re in the last line of the data.
+
+    >>> prompt = DeviceCiscoIOS.prompt
+    >>> _matchEnd(prompt, b"show clock\r\nR1#").group()
+    b'#'
+    >>> _matchEnd(prompt, b"R1#show clock\r\n50%#\r\n") is None
+    True
+    """
+    end = len(data)
+    while end and data[end - 1] in b" \t":
+        end -= 1
+    return prompt_re.search(data, data.rfind(b"\n", 0, end) + 1)
+
+
+@lru_cache(maxsize=16)
+def _commandLines(commands):
+    """Return the commands as the lines to send, and all of them joined.
+
+    An Activity sends the same commands to all its targets, so they are
+        encoded once per tuple of commands.
+    """
+    lines = tuple(c.encode("utf-8") + b"\n" for c in commands)
+    return lines, b"".join(lines)
+
+
+@lru_cache(maxsize=64)
+def _promptLineRegex(promptLine):
+    r"""Return the regex matching the lines that start like the promptLine.
+
+    The prompt changes with the mode or the current directory, so only its
+        first word, usually the hostname, must be the same. Terminal escape
+        sequences and symbols like '[' before that word are skipped.
+    Returns None if the promptLine has no such word.
+
+    >>> output = b"R1#conf t\r\nR1(config)#end\r\nR1#"
+    >>> len(_promptLineRegex(b"R1#").findall(output))
+    3
+    >>> output = b"[me@box ~]$ cd /etc\r\n[me@box etc]$ "
+    >>> len(_promptLineRegex(b"[me@box ~]$ ").findall(output))
+    2
+    >>> output = b"\x1b[?2004hme@box:~$ ls\r\n\x1b[?2004l\r50%\r\n"
+    >>> len(_promptLineRegex(b"\x1b[?2004hme@box:~$ ").findall(output))
+    1
+    >>> _promptLineRegex(b"$ ") is None
+    True
+    """
+    word = _promptWord.match(promptLine)
+    if word is None:
+        return None
+    return re.compile(
+        rb"(?m)^" + _promptLead + re.escape(word.group(1))
+        + rb"[^\r\n]*?[>#$%]")
+
+
+@lru_cache(maxsize=None)
+def _expectRegex(patterns):
+    """Return the regex matching any of the patterns at the end of the data.
+
+    Each pattern is a group, so the matched one is the match.lastindex.
+    """
+    return re.compile(
+        b"(?:" + b"|".join(b"(" + re.escape(p) + b")" for p in patterns)
+        + rb")[ \t]*\Z")
+
+
+@atexit.register
+def closeConnections():
+    """Close all the SSH connections kept for reuse."""
+    with _clientCacheLock:
+        clients = list(_idleClients)
+        _idleClients.clear()
+    for client in clients:
+        client.close()
 
 
 class Device(object):
@@ -54,76 +238,229 @@ class Device(object):
         aDevice.super() #if needed
         aDevice.run({"","",""},outfile)
         aDevice.logout()
+        aDevice.close()
     """
 
+    # The end of the data when the device waits for input
+    prompt = re.compile(rb"[>#$%][ \t]*\Z")
+    # True if all the commands can be sent at once, before reading the output
+    pipeline = True
+    # True if connect() opens the interactive shell, False if opened later
+    shellOnConnect = True
+
     def __init__(self, hostname):
         """Build."""
         self.hostname = hostname
-        self.SSHClient = paramiko.SSHClient()
+        self.SSHClient = None
         self.RemoteShell = None
         self.username = ""
         self.password = ""
+        # The last line received, if it was a prompt. None if not at a prompt
+        self._promptLine = None
 
     def connect(self, username, password):
         """Brings up the SSH connection, if possible, using the credentials.
 
+        An SSH connection to the same hostname, with the same credentials,
+            left open by a Device already closed is reused if it accepts
+            a new shell. Otherwise a new SSH connection is established.
+
         No command is typed once the SSH session is open.
         Returns True if connection ok, False if not.
         """
         self.username = username
         self.password = password
         try:
-            self.SSHClient.set_missing_host_key_policy(
-                paramiko.AutoAddPolicy())
-            self.SSHClient.connect(
-                self.hostname,
-                username=username,
-                password=password,
-                allow_agent=False,
-                look_for_keys=False)
-            self.RemoteShell = self.SSHClient.invoke_shell()
+            self.SSHClient = _takeIdleClient(
+                self.hostname, username, password)
+            if self.SSHClient is not None:
+                try:
+                    if self.shellOnConnect:
+                        self._openShell()
+                    return True
+                except (ParamikoExcept.SSHException, SocketError):
+                    # Some servers take a single session per connection
+                    self.SSHClient.close()
+                    self.SSHClient = None
+            self.SSHClient = _newClient(self.hostname, username, password)
+            if self.shellOnConnect:
+                self._openShell()
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write(
                     "Device.connect to '%s' caused Exception %s"
                     % (self.hostname, e))
+            self.close()
             return False
 
+    def _openShell(self):
+        """Open the interactive shell on the SSHClient connection."""
+        channel = self.SSHClient.get_transport().open_session(
+            window_size=_windowSize)
+        try:
+            channel.get_pty()
+            channel.invoke_shell()
+        except BaseException:
+            channel.close()
+            raise
+        self.RemoteShell = channel
+
     def run(self, commands, outfile):
         r"""Run a list of commands and writes the output to a file.
 
         File must be already opened when passed.
 
+        If the Device.pipeline is True, all the commands are sent at once
+            and the output is read until a prompt came after each of them.
+
         Returns True if all commands were sent ok, False if not.
 
         Parameters:
         * commands: a list of strings witht the commands.
             No need to have "\n" at the end.
-        * outfile: a file pointer to write data to.
+        * outfile: a binary file pointer to write data to.
             This file must have been opened and accepting input.
+            The data is written as received from the device, not decoded.
 
         """
         cmd = ""
+        lines, payload = _commandLines(tuple(commands))
         try:
-            while self.RemoteShell.recv_ready():
-                data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            data = self._read_ready()
+            outfile.write(data)
+            if self.pipeline and commands:
+                if data:
+                    self._notePrompt(data)
+                if self._promptLine is None:
+                    # The prompt must be known to count it in the output
+                    outfile.write(self._read_until(self.prompt))
+            promptLine_re = None
+            if self.pipeline and commands and self._promptLine is not None:
+                promptLine_re = _promptLineRegex(self._promptLine)
+            # Without a prompt to count, the commands are sent one by one
+            if promptLine_re is not None:
+                cmd = commands[-1]
+                self.RemoteShell.sendall(payload)
+                data, complete = self._read_pipelined(
+                    len(commands), promptLine_re)
                 outfile.write(data)
-            for cmd in commands:
-                if self.RemoteShell.send(cmd + "\n") == 0:
+                return complete
+            for cmd, line in zip(commands, lines):
+                if self.RemoteShell.send(line) == 0:
                     raise IOError
-                time.sleep(2)
-                while self.RemoteShell.recv_ready():
-                    data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-                    outfile.write(data)
+                data = self._read_until(self.prompt)
+                outfile.write(data)
             return True
-        except (ParamikoExcept.SSHException, SocketError, UnicodeDecodeError) as e:
+        except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write(
                     "Device.run: Command '%s' caused exception %s"
                     % (cmd, e))
             return False
 
+    def _read_ready(self):
+        """Return the data already received, without waiting for more."""
+        data = bytearray()
+        while self.RemoteShell.recv_ready():
+            data.extend(self.RemoteShell.recv(_bufferSize))
+        return data
+
+    def _read_until(self, prompt_re, timeout=_promptTimeout):
+        """Return the data received until the prompt_re matches.
+
+        Stops reading as soon as the prompt_re is found in the data,
+            the SSH channel is closed, or nothing arrives for timeout
+            seconds, so a long output is not cut while it is coming.
+        Only the new data, and the last _promptScanSize bytes before it,
+            are searched after each read.
+
+        Parameters:
+        * prompt_re: a compiled bytes regular expression.
+        * timeout: maximum number of seconds to wait for more data.
+
+        """
+        data = bytearray()
+        try:
+            self.RemoteShell.settimeout(timeout)
+            while True:
+                chunk = self.RemoteShell.recv(_bufferSize)
+                if not chunk:
+                    break
+                scanFrom = max(0, len(data) - _promptScanSize)
+                data.extend(chunk)
+                if prompt_re.search(data, scanFrom):
+                    break
+        except SocketTimeout:
+            pass
+        finally:
+            self.RemoteShell.settimeout(None)
+        if data:
+            self._notePrompt(data)
+        return data
+
+    def _notePrompt(self, data):
+        """Keep the last line of the data as the _promptLine, if it is one."""
+        if _endsWith(self.prompt, data):
+            self._promptLine = bytes(data[data.rfind(b"\n") + 1:])
+        else:
+            self._promptLine = None
+
+    def _expect(self, patterns, timeout=_promptTimeout):
+        """Wait for the device to answer with one of the patterns.
+
+        Returns (index, data), where index is the position in patterns of
+            the one the data ends with, or -1 if none was received before
+            the timeout or the channel closed.
+
+        Parameters:
+        * patterns: a tuple of bytes, the texts the device could end with.
+        * timeout: maximum number of seconds to wait for more data.
+
+        """
+        expect_re = _expectRegex(patterns)
+        data = self._read_until(expect_re, timeout)
+        match = _matchEnd(expect_re, data)
+        if match is None:
+            return -1, data
+        return match.lastindex - 1, data
+
+    def _read_pipelined(self, count, promptLine_re):
+        """Return the output of count commands sent at once.
+
+        Each command ends when the prompt comes again at the start of a
+            line, so the reading stops after count prompt lines, or when
+            nothing arrives for _promptTimeout seconds.
+        Returns (data, True if all the prompts were received).
+
+        The promptLine_re, from the _promptLine seen before sending the
+            commands, tells which lines are prompts.
+        """
+        data = bytearray()
+        seen = 0
+        lastLine = 0
+        atPrompt = False
+        try:
+            self.RemoteShell.settimeout(_promptTimeout)
+            while seen + atPrompt < count:
+                chunk = self.RemoteShell.recv(_bufferSize)
+                if not chunk:
+                    break
+                data.extend(chunk)
+                # Complete lines are counted once, the last one when it ends
+                end = data.rfind(b"\n", lastLine) + 1
+                if end:
+                    seen += len(promptLine_re.findall(data, lastLine, end))
+                    lastLine = end
+                atPrompt = promptLine_re.match(data, lastLine) is not None
+        except SocketTimeout:
+            pass
+        finally:
+            self.RemoteShell.settimeout(None)
+        if data:
+            self._notePrompt(data)
+        return data, seen + atPrompt >= count
+
     def superuser(self, password):
         """Do nothingself.
 
@@ -150,23 +487,38 @@ class Device(object):
         """Do Nothing.
 
         The default Device does not send any command,
-            just closes the SSH session via TCP close.
+            just closes the shell of the SSH session.
+        The SSH connection is kept open for reuse, see closeConnections().
 
         The session might not be availabe for logout if any 'close' or 'logout'
         was among the executed commands.
         """
         try:
-            self.RemoteShell.close()
-            self.SSHClient.close()
+            self.close()
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write("Device.logout: Exception %s" % e)
 
+    def close(self):
+        """Close the shell, and release the SSH connection for reuse.
+
+        Can be called several times, and even if connect() failed.
+        """
+        if self.RemoteShell is not None:
+            self.RemoteShell.close()
+            self.RemoteShell = None
+        if self.SSHClient is not None:
+            _releaseClient(
+                self.hostname, self.username, self.password, self.SSHClient)
+            self.SSHClient = None
+
 
 class DeviceCiscoIOS(Device):
     """Device specific for Cisco IOS switches and routers."""
 
+    prompt = re.compile(rb"[>#][ \t]*\Z")
+
     def superuser(self, password):
         """Enable mechanism.
 
@@ -178,22 +530,14 @@ class DeviceCiscoIOS(Device):
         """
         result = False
         try:
-            while self.RemoteShell.recv_ready():
-                self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            self._read_ready()
             self.RemoteShell.send("enable \n")
-            data = ""
-            time.sleep(1)
-            while self.RemoteShell.recv_ready():
-                data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-            if data.find("Password:") != -1:
+            index, _ = self._expect((b"Password:", b"#", b">"))
+            if index == 0:
                 self.RemoteShell.send(password + "\n")
-                data = ""
-                time.sleep(1)
-                while self.RemoteShell.recv_ready():
-                    data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-                if data.find("#") != -1:
-                    result = True
-        except ParamikoExcept.SSHException as e:
+                index, _ = self._expect((b"#", b">"))
+                result = index == 0
+        except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write("DeviceCiscoIOS.superuser: Exception %s" % e)
         return result
@@ -204,12 +548,11 @@ class DeviceCiscoIOS(Device):
         Returns False if there were any errors while loging out.
         """
         try:
-            while self.RemoteShell.recv_ready():
-                self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            self._read_ready()
             self.RemoteShell.send("end \n")
-            time.sleep(1)
+            self._read_until(self.prompt)
             self.RemoteShell.send("exit \n")
-            time.sleep(1)
+            self._read_until(self.prompt)
             super(DeviceCiscoIOS, self).logout()
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
@@ -226,10 +569,9 @@ class DeviceCiscoIOS(Device):
         Returns True if connection is ok, False if not.
         """
         try:
-            while self.RemoteShell.recv_ready():
-                self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            self._read_ready()
             self.RemoteShell.send("terminal length 0 \n")
-            time.sleep(1)
+            self._read_until(self.prompt)
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
@@ -251,6 +593,12 @@ class DeviceCiscoWLC(Device):
         y
     """
 
+    # The '>' prompt, or a question like 'Are you sure ... save? (y/n)'
+    prompt = re.compile(rb"(>|\([yY]/[nN]\))[ \t]*\Z")
+    # Questions like 'Are you sure?' must be answered one command at a time
+    pipeline = False
+    _saveQuestion = re.compile(rb"save\?|\(y/N\)")
+
     def logout(self):
         """Send the 'end' and 'exit' commands before closing the SSH session.
 
@@ -260,15 +608,12 @@ class DeviceCiscoWLC(Device):
         """
         try:
             self.RemoteShell.send("end \n")
-            time.sleep(1)
+            self._read_until(self.prompt)
             self.RemoteShell.send("exit \n")
-            time.sleep(1)
-            data = ""
-            while self.RemoteShell.recv_ready():
-                data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-            if data.find("save?") != -1:
+            data = self._read_until(self._saveQuestion)
+            if self._saveQuestion.search(data):
                 self.RemoteShell.send("No \n")
-                time.sleep(1)
+                self._read_until(self.prompt)
             super(DeviceCiscoWLC, self).logout()
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
@@ -284,17 +629,15 @@ class DeviceCiscoWLC(Device):
         """
         try:
             self.RemoteShell.send(self.username + "\n")
-            time.sleep(1)
-            while self.RemoteShell.recv_ready():
-                self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            index, _ = self._expect((b"Password:",))
+            if index != 0:
+                return False
             self.RemoteShell.send(self.password + "\n")
-            time.sleep(1)
-            while self.RemoteShell.recv_ready():
-                data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-            if data.find(">") == -1:
+            index, _ = self._expect((b">", b"User:"))
+            if index != 0:
                 return False
             self.RemoteShell.send("config paging disable \n")
-            time.sleep(1)
+            self._expect((b">",))
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
@@ -305,35 +648,32 @@ class DeviceCiscoWLC(Device):
 class DeviceLinux(Device):
     """Device specific for Linux using 'su'."""
 
+    prompt = re.compile(rb"[#$][ \t]*\Z")
+    _rootPrompt = re.compile(rb"root[^\r\n]*#[ \t]*\Z")
+
     def superuser(self, password):
         """Send 'su' command and expects 'Password:' as reply.
 
         Then inputs the Root password and checks that the prompt
             contains 'root' string.
-        Returns True if after the 'su', the prompt sais 'root'. False if not.
+        Returns True if after the 'su', the prompt sais 'root' and ends
+            in '#'. False if not.
 
         Parameters:
         * password:  Clear text root password
 
         """
         try:
-            while self.RemoteShell.recv_ready():
-                self.RemoteShell.recv(_bufferSize).decode("utf-8")
+            self._read_ready()
             self.RemoteShell.send("su \n")
-            data = ""
-            time.sleep(1)
-            while self.RemoteShell.recv_ready():
-                data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-            if data.find("Password:") != -1:
+            index, _ = self._expect((b"Password:", b"#", b"$"))
+            if index == 0:
                 self.RemoteShell.send(password + "\n")
-                data = ""
-                time.sleep(1)
-                while self.RemoteShell.recv_ready():
-                    data = self.RemoteShell.recv(_bufferSize).decode("utf-8")
-                if data.find("root") != -1:
+                index, data = self._expect((b"#", b"$"))
+                if index == 0 and _endsWith(self._rootPrompt, data):
                     return True
             return False
-        except (ParamikoExcept.SSHException, UnicodeDecodeError) as e:
+        except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write("DeviceLinux.superuser Exception %s" % e)
             return False
@@ -345,10 +685,106 @@ class DeviceLinux(Device):
         """
         try:
             self.RemoteShell.send("logout \n")
-            time.sleep(1)
+            self._read_until(self.prompt)
             super(DeviceLinux, self).logout()
             return True
         except (ParamikoExcept.SSHException, SocketError) as e:
             if _debug:
                 sys.stderr.write("DeviceLinux.logout Exception %s" % e)
             return False
+
+
+class DeviceLinuxExec(DeviceLinux):
+    """Device for Linux, running each command on its own exec channel.
+
+    The commands do not share a shell, so a 'cd' or a variable set by one
+        command is lost for the next ones. Only for independent commands.
+    The interactive shell is only opened for superuser().
+    """
+
+    shellOnConnect = False
+
+    def __init__(self, hostname):
+        """Build."""
+        super(DeviceLinuxExec, self).__init__(hostname)
+        self.isRoot = False
+
+    def run(self, commands, outfile):
+        r"""Run each command on its own exec channel, without prompts.
+
+        The channels share the SSH connection, and each command is done
+            when its channel closes. After a 'su' the commands must go to
+            the root shell, so then they are typed as in Device.run().
+        A command silent for _promptTimeout seconds is left with the output
+            received so far, and the next one is run.
+
+        Returns True if all commands ran to the end, False if not.
+
+        Parameters:
+        * commands: a list of strings witht the commands.
+            No need to have "\n" at the end.
+        * outfile: a binary file pointer to write data to.
+
+        """
+        if self.isRoot:
+            return super(DeviceLinuxExec, self).run(commands, outfile)
+        cmd = ""
+        lines, _ = _commandLines(tuple(commands))
+        result = True
+        try:
+            transport = self.SSHClient.get_transport()
+            for cmd, line in zip(commands, lines):
+                data = bytearray(b"$ " + line)
+                channel = transport.open_session(window_size=_windowSize)
+                try:
+                    channel.set_combine_stderr(True)
+                    channel.settimeout(_promptTimeout)
+                    channel.exec_command(cmd)
+                    chunk = channel.recv(_bufferSize)
+                    while chunk:
+                        data.extend(chunk)
+                        chunk = channel.recv(_bufferSize)
+                except SocketTimeout:
+                    if _debug:
+                        sys.stderr.write(
+                            "DeviceLinuxExec.run: Command '%s' timed out"
+                            % cmd)
+                    result = False
+                finally:
+                    channel.close()
+                outfile.write(data)
+            return result
+        except (ParamikoExcept.SSHException, SocketError) as e:
+            if _debug:
+                sys.stderr.write(
+                    "DeviceLinuxExec.run: Command '%s' caused exception %s"
+                    % (cmd, e))
+            return False
+
+    def superuser(self, password):
+        """See DeviceLinux.superuser(), the commands then go to that shell."""
+        if self.RemoteShell is None:
+            try:
+                self._openShell()
+            except (ParamikoExcept.SSHException, SocketError) as e:
+                if _debug:
+                    sys.stderr.write(
+                        "DeviceLinuxExec.superuser Exception %s" % e)
+                return False
+        self.isRoot = super(DeviceLinuxExec, self).superuser(password)
+        return self.isRoot
+
+    def logout(self):
+        """Type 'logout' if the shell was opened, then close the session."""
+        if self.RemoteShell is None:
+            return Device.logout(self)
+        return super(DeviceLinuxExec, self).logout()
+
+
+# Device class for each of the listOfDeviceTypes, see deviceFactoryFor()
+_deviceClasses = {
+    "ciscoios": DeviceCiscoIOS,
+    "ciscowlc": DeviceCiscoWLC,
+    "linux": DeviceLinux,
+    "linuxexec": DeviceLinuxExec,
+}
@@ -13,27 +13,45 @@ This tool is designed to be run as a crontab job, or independently.
 
     python3 sshRemoteControl.py  <XML file>
     python3 sshRemoteControl.py  <JSON file>
+    python3 sshRemoteControl.py  -w 8 <XML file>
     python3 sshRemoteControl.py  -h
 """
 
 import os
-import sys
 import os.path
+import argparse
 from lib.Activity import Activity
 
 
-def banner():
-    """Print a banner on STDOUT about how to call this program."""
-    print("""
-Usage:
-    sshRemoteControl.py <file>
-        <file> is the XML or JSON task file.
-        It must end in either .xml or .json
-
-    sshRemoteControl.py -h|--help
-
-by Ignacio Tamayo (c) 2018. tamayo_j@minet.net
-""")
+def parser():
+    """Return the parser of the command line arguments."""
+    aParser = argparse.ArgumentParser(
+        prog="sshRemoteControl.py",
+        description="Runs the Task described in an XML or JSON file.",
+        epilog="by Ignacio Tamayo (c) 2018. tamayo_j@minet.net")
+    aParser.add_argument(
+        "file",
+        help="the XML or JSON task file. "
+             "It must end in either .xml or .json")
+    aParser.add_argument(
+        "-w", "--workers",
+        type=positiveInt,
+        metavar="N",
+        help="number of devices connected to at the same time. "
+             "By default, 32. With 1, devices are processed one by one.")
+    return aParser
+
+
+def positiveInt(text):
+    """Return the text as an int, if it is >0. For argparse."""
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid number of workers '%s'" % text)
+    return value
 
 
 def execute():
@@ -46,31 +64,17 @@ def execute():
 
     The local directories are ./output and ./logs
     This functions expects parameters in 'sys.argv'
+    Wrong arguments, or -h|--help, exit through argparse.
     """
-    if len(sys.argv) is not 2:
-        print("ERR: Wrong number of arguments")
-        banner()
-        return 7
-    elif len(sys.argv) == 2:
-        if sys.argv[1].lower() in ("-h", "--help"):
-            banner()
-            return 0
-        else:
-            filename = os.path.abspath(sys.argv[1])
-            if os.path.exists(filename):
-                # If the Path passed as argument is a valid path to file
-                return runTask(filename)
-            else:
-                print("ERR: Invalid file '%s'" % filename)
-                banner()
-                return 8
-    else:
-        print("Invalid arguments")
-        banner()
-        return 3
+    args = parser().parse_args()
+    filename = os.path.abspath(args.file)
+    if not os.path.exists(filename):
+        print("ERR: Invalid file '%s'" % filename)
+        return 8
+    return runTask(filename, args.workers)
 
 
-def runTask(filename):
+def runTask(filename, workers=None):
     """Given a Task described in a File, the Task is run.
 
     Returns 0 if the task was run (not the result of the task execution),
@@ -81,38 +85,39 @@ def runTask(filename):
 
     Parameters:
     * filename: A filename that describes the Task, in XML or JSON format.
-      It must be an absolute path. It must end in .xml or .json.
+      It must be an absolute path to an existing file.
+      It must end in .xml or .json.
+    * workers: Number of devices to connect to at the same time.
+      If None, the Activity default is used.
 
     """
-    if not os.path.exists(filename):
-        return 9
-    filename, file_extension = os.path.splitext(filename)
-
     anActivity = Activity()
 
-    if file_extension.lower() in (".xml", ".json"):
-        if file_extension.lower() == ".xml":
-            if not anActivity.loadFromXML(sys.argv[1]):
-                print("ERR: Unable to load from XML file")
-                return 11
-        else:
-            if not anActivity.loadFromJSON(sys.argv[1]):
-                print("ERR: Unable to load from JSON file")
-                return 12
-        try:
-            anActivity.check()
-        except ValueError as e:
-            print("ERR: Activity file is not valid: %s" % e)
-            return 13
+    lowerFilename = filename.lower()
+    if lowerFilename.endswith(".xml"):
+        loadTask, errorCode, fileFormat = anActivity.loadFromXML, 11, "XML"
+    elif lowerFilename.endswith(".json"):
+        loadTask, errorCode, fileFormat = anActivity.loadFromJSON, 12, "JSON"
     else:
         print("ERR: Invalid file extension")
         return 13
+    if not loadTask(filename):
+        print("ERR: Unable to load from %s file" % fileFormat)
+        return errorCode
+    try:
+        anActivity.check()
+    except ValueError as e:
+        print("ERR: Activity file is not valid: %s" % e)
+        return 13
 
     anActivity.printSummary()
 
     print("Running...")
     try:
-        anActivity.run()
+        if workers:
+            anActivity.run(workers)
+        else:
+            anActivity.run()
     except KeyboardInterrupt:
         return 99
     return 0
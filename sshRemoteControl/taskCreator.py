@@ -15,59 +15,56 @@ Example:
 """
 
 import os
-import sys
 import os.path
+import argparse
 from getpass import getpass
 from lib import Activity, Devices
 
+_yesAnswers = frozenset(("y", "ye", "yes"))  # Lower-cased, for inputYesNo()
 
-def banner():
-    """Print a banner on STDOUT about how to call this program."""
-    print("""
-Usage:
 
-    taskCreator.py <file>
-        <file> is the XML or JSON file to write.
-        It must end in either .xml or .json
-
-    taskCreator.py -e|--encrypt
-        Takes a password on STDIN and retuns it encrypted.
-        Used to manually edit Task files.
-
-    taskCreator.py -h|--help
-
-by Ignacio Tamayo (c) 2018. tamayo_j@minet.net
-""")
+def parser():
+    """Return the parser of the command line arguments."""
+    aParser = argparse.ArgumentParser(
+        prog="taskCreator.py",
+        description="Writes a Task file from the console input.",
+        epilog="by Ignacio Tamayo (c) 2018. tamayo_j@minet.net")
+    aParser.add_argument(
+        "file",
+        nargs="?",
+        help="the XML or JSON file to write. "
+             "It must end in either .xml or .json")
+    aParser.add_argument(
+        "-e", "--encrypt",
+        action="store_true",
+        help="takes a password on STDIN and retuns it encrypted. "
+             "Used to manually edit Task files.")
+    return aParser
 
 
 def execute():
     """Run main Routine.
 
-    1) Checks the 2 arguments passed from the command line
+    1) Checks the arguments passed from the command line
     2) If there is an argument, it is interpreted as a destinatino filename and
         the Task creation is tried.
 
     Returns 0 if all was OK, <>0 as ERRORCODE value.
+    Wrong arguments, or -h|--help, exit through argparse.
     """
-    if len(sys.argv) is not 2:
-        print("ERR: Wrong number of arguments")
-        banner()
-        return 7
-    elif len(sys.argv) == 2:
-        try:
-            if sys.argv[1].lower() in ("-h", "--help"):
-                banner()
-                return 0
-            elif sys.argv[1].lower() in ("-e", "--encrypt"):
-                return printEncrypt()
-            else:
-                return makeTask(sys.argv[1])
-        except KeyboardInterrupt:
-            return 99
-    else:
-        print("ERR: Invalid arguments")
-        banner()
-        return 8
+    aParser = parser()
+    args = aParser.parse_args()
+    try:
+        if args.encrypt:
+            return printEncrypt()
+        elif args.file:
+            return makeTask(args.file)
+        else:
+            print("ERR: Wrong number of arguments")
+            aParser.print_help()
+            return 7
+    except KeyboardInterrupt:
+        return 99
 
 
 def printEncrypt():
@@ -103,36 +100,31 @@ def makeTask(filename):
         It must be an absolute path. It must end in .xml or .json.
 
     """
-    filename, file_extension = os.path.splitext(filename)
-    anActivity = Activity.Activity()
-    if file_extension.lower() not in (".xml", ".json"):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in (".xml", ".json"):
         print("ERR: Invalid file '%s'" % filename)
         return 13
+    anActivity = Activity.Activity()
     # Ask the user the Task Values and put them in the Task
     print("\nBEWARE: Case sEnSiTIVe input!\n")
     if not fillFromCLI(anActivity):
         print("ERR: Activity not created")
         return 16
     # The user created a good TASK
-    if file_extension.lower() == ".xml":
-        if not anActivity.writeToXML(sys.argv[1]):
-            print("ERR: Unable to write from XML file")
-            return 11
-    elif file_extension.lower() == ".json":
-        if not anActivity.writeToJSON(sys.argv[1]):
-            print("ERR: Unable to write from JSON file")
-            return 12
+    writeTask, errorCode, fileFormat = {
+        ".xml": (anActivity.writeToXML, 11, "XML"),
+        ".json": (anActivity.writeToJSON, 12, "JSON"),
+    }[ext]
+    if not writeTask(filename):
+        print("ERR: Unable to write from %s file" % fileFormat)
+        return errorCode
     anActivity.printSummary()
     print("End")
 
 
 def inputYesNo(mesg):
     """Print the message, if STDIN input is Y|Ye|Yes, returns True."""
-    text = input(mesg)
-    if text.lower() == "y" or text.lower() == "ye" or text.lower() == "yes":
-        return True
-    else:
-        return False
+    return input(mesg).strip().lower() in _yesAnswers
 
 
 def fillFromCLI(anActivity):